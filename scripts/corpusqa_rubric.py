@@ -1,22 +1,54 @@
-import itertools
+import asyncio
 import logging
-from typing import Any, Dict, List
+import operator
+from typing import Any, Callable, Dict, List, Tuple, Type
 
-from pydantic.v1 import BaseModel, Field
-
-from run_utils import extract_json_from_response, run_chatopenai
+import msgspec
+from run_utils import extract_json_from_response, run_chatopenai_async, run_sync
 
 LOGGER = logging.getLogger(__name__)
 
+STATIC_SCORE_KEYS = frozenset({"length", "expertise", "citations", "excerpts"})
+
+# Static prompt bodies, the templates only get their counts filled in per call
+PROPERTY_SYSTEM_PROMPT = """You will be given a question someone asked (in <question></question> tags) and the corresponding response (in <response></response> tags) given to them by an assistant.  You will then be given a specific criterion of the response to evaluate (in <criterion></criterion> tags).
+Return a score on a scale of 0 to 10 indicating how appropriate the response is based on the given criterion.  Judge only the specified aspect(s), not any other qualities of the answer.  Output JSON in the format: {{"score": x}}."""
+PROPERTY_BATCH_SYSTEM_PROMPT = """You will be given a question someone asked (in <question></question> tags) and the corresponding response (in <response></response> tags) given to them by an assistant.  You will then be given {n_criteria} specific criteria of the response to evaluate, numbered from 1 to {n_criteria} (in <criterion i="..."></criterion> tags).
+Return a score on a scale of 0 to 10 for every criterion indicating how appropriate the response is based on that criterion.  Judge each criterion independently and only for the specified aspect(s), not any other qualities of the answer.  Output JSON in the format: {{"scores": [{{"i": 1, "score": x}}, ...]}}."""
+EXPERTISE_CRITERION = "The level of expertise required to understand the answer should be roughly aligned with the estimated expertise of a typical person who would ask the question."
+EVIDENCE_SYSTEM_PROMPT = """You are given the response given by a scientific assistant to a user query enclosed in <response></response> tags.
+              In addition you are also given a list of snippets numbered from 1 to {n_snippets} enclosed in <snippets></snippets> tags, which should be present in the true answer. 
+              Your job is to count how many snippets out of the given list are relevant to the provided response. 
+              A snippet is relevant if the information provided by it is partly or completely present in the response. Count every snippet only once. 
+              Output JSON with the count as a number in the format: {{"score": x}}."""
+CLAIMS_USER_PROMPT_HEAD = """Here is a response to a question that includes several claims and citations:
+Response: """
+CLAIMS_USER_PROMPT_TAIL = (
+    "\n\nSplit the response into individual claims, citations, and excerpts from the citations, in JSON format: "
+    '{"claims": [{"claim_text": "...", "citations": [{"citation_text": "...", "excerpts": ["...", ...]}, ...]}, ...]}'
+    "\n\nIf a claim is missing citations or a citation is not accompanied by excerpts, some lists may be empty in your output."
+)
+
+
+def struct_kwargs(struct_type: Type[msgspec.Struct], values: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop the keys of ``values`` that are not fields of ``struct_type``, which ``msgspec.convert`` ignores too."""
+    return {k: v for k, v in values.items() if k in struct_type.__struct_fields__}
+
+
+def make_weighted_sum(weights: Dict[str, float]) -> Callable[[Dict[str, float]], float]:
+    """Build a function that computes the weighted sum of score components for a fixed set of ``weights``."""
+    keys, values = tuple(weights), tuple(weights.values())
+    return lambda components: sum(map(operator.mul, values, map(components.__getitem__, keys)))
 
-class CorpusQaRubricPropertyConfig(BaseModel):
+
+class CorpusQaRubricPropertyConfig(msgspec.Struct):
     name: str
     criterion: str
     weight: float
-    evidence: List[str] = Field(default_factory=list)
+    evidence: List[str] = msgspec.field(default_factory=list)
 
 
-class CorpusQaRubricConfig(BaseModel):
+class CorpusQaRubricConfig(msgspec.Struct):
     question: str
     low_length: int = 300
     high_length: int = 600
@@ -24,13 +56,46 @@ class CorpusQaRubricConfig(BaseModel):
     expertise_weight: float = 0.05
     citations_weight: float = 0.2
     excerpts_weight: float = 0.1
-    other_properties: List[CorpusQaRubricPropertyConfig] = Field(default_factory=list)
+    other_properties: List[CorpusQaRubricPropertyConfig] = msgspec.field(default_factory=list)
     model_name: str = "gpt-4-turbo"
+    batch_criteria: bool = False
+    # Evidence of a property is only scored if its criterion score is above this threshold
+    evidence_gate: float = 0.0
 
 
 class RubricCorpusQaGenericMetric:
-    def __init__(self, config: Dict[str, Any]):
-        self.config = CorpusQaRubricConfig.parse_obj(config)
+    def __init__(self, config: Dict[str, Any], validate: bool = False):
+        if validate:
+            self.config = msgspec.convert(config, type=CorpusQaRubricConfig)
+        else:
+            # Configs generated by create_test_cases.py are trusted, so skip the validation overhead
+            self.config = CorpusQaRubricConfig(
+                **{
+                    **struct_kwargs(CorpusQaRubricConfig, config),
+                    "other_properties": [
+                        CorpusQaRubricPropertyConfig(**struct_kwargs(CorpusQaRubricPropertyConfig, prop))
+                        for prop in config.get("other_properties", [])
+                    ],
+                }
+            )
+
+        self._score_weights = {
+            "length": self.config.length_weight,
+            "expertise": self.config.expertise_weight,
+            "citations": self.config.citations_weight,
+            "excerpts": self.config.excerpts_weight,
+        }
+        self._score_weights.update(
+            {x.name: x.weight / (2.0 if x.evidence else 1.0) for x in self.config.other_properties if x.criterion})
+        self._score_weights.update(
+            {f"{x.name}_evidence": x.weight / (2.0 if x.criterion else 1.0) for x in self.config.other_properties if
+             x.evidence})
+        assert abs(sum(self._score_weights.values()) - 1.0) < 1e-6
+        ann_weights = {k: w for k, w in self._score_weights.items() if k not in STATIC_SCORE_KEYS}
+        # Share of the annotation rubrics in the total score, used to get their score out of 1
+        self._ann_denominator = sum(ann_weights.values())
+        self._aggregate = make_weighted_sum(self._score_weights)
+        self._aggregate_ann = make_weighted_sum(ann_weights)
 
     def _score_length(self, response: str, low_length, high_length) -> float:
         """
@@ -47,7 +112,7 @@ class RubricCorpusQaGenericMetric:
                 / (high_length - low_length)
         )
 
-    def _score_property(self, response: str, question: str, prop: str) -> float:
+    async def _score_property(self, response: str, question: str, prop: str) -> float:
         """
         Score the response as per the annotation rubric/criterion represented here by ``prop``.
         The score is calculated by asking an LLM to judge the response for satisfaction of the rubric/criterion
@@ -57,10 +122,9 @@ class RubricCorpusQaGenericMetric:
         :param prop: the rubric/criterion to be satisfied
         :return: score between 0 and 1 after normalizing the LLM score
         """
-        resp = run_chatopenai(
+        resp = await run_chatopenai_async(
             self.config.model_name,
-            system_prompt="""You will be given a question someone asked (in <question></question> tags) and the corresponding response (in <response></response> tags) given to them by an assistant.  You will then be given a specific criterion of the response to evaluate (in <criterion></criterion> tags).
-Return a score on a scale of 0 to 10 indicating how appropriate the response is based on the given criterion.  Judge only the specified aspect(s), not any other qualities of the answer.  Output JSON in the format: {{"score": x}}.""",
+            system_prompt=PROPERTY_SYSTEM_PROMPT,
             user_prompt=f"""<question>{question}</question>\n<response>{response}</response>\n<criterion>{prop}</criterion>""",
             json_mode=True,
             max_tokens=100,
@@ -72,7 +136,7 @@ Return a score on a scale of 0 to 10 indicating how appropriate the response is
 
         return obj["score"] / 10.0
 
-    def _score_evidence(self, response: str, evidence: List[str]) -> float:
+    async def _score_evidence(self, response: str, evidence: List[str]) -> float:
         """
         Score the response based on the snippets provided as supporting quotes with the rubric.
         The score is the fraction of the snippets that are present in the response, as detected by an LLM.
@@ -81,13 +145,9 @@ Return a score on a scale of 0 to 10 indicating how appropriate the response is
         :return: normalized count of snippets present in the response
         """
         snippets = "\n".join(f"{i + 1}. {x}" for i, x in enumerate(evidence))
-        resp = run_chatopenai(
+        resp = await run_chatopenai_async(
             self.config.model_name,
-            system_prompt=f"""You are given the response given by a scientific assistant to a user query enclosed in <response></response> tags.
-              In addition you are also given a list of snippets numbered from 1 to {len(evidence)} enclosed in <snippets></snippets> tags, which should be present in the true answer. 
-              Your job is to count how many snippets out of the given list are relevant to the provided response. 
-              A snippet is relevant if the information provided by it is partly or completely present in the response. Count every snippet only once. 
-              Output JSON with the count as a number in the format: {{"score": x}}.""",
+            system_prompt=EVIDENCE_SYSTEM_PROMPT.format(n_snippets=len(evidence)),
             user_prompt=f"""<response>{response}</response>\n<snippets>{snippets}</snippets>""",
             json_mode=True,
             max_tokens=100,
@@ -99,17 +159,17 @@ Return a score on a scale of 0 to 10 indicating how appropriate the response is
             return 0.0
         return min(obj["score"] / len(evidence), 1.0)
 
-    def _score_citations_excerpts(self, response: str) -> Dict[str, float]:
+    async def _score_citations_excerpts(self, response: str) -> Dict[str, float]:
 
         try:
-            score_components = self._score_citations_excerpts_inner(response)
+            score_components = await self._score_citations_excerpts_inner(response)
         except (KeyError, TypeError) as e:
             LOGGER.warning(f"Could not extract citations and excerpts: {e}")
             score_components = {"citations": 0.0, "excerpts": 0.0}
 
         return score_components
 
-    def _score_citations_excerpts_inner(self, response: str) -> Dict[str, float]:
+    async def _score_citations_excerpts_inner(self, response: str) -> Dict[str, float]:
         """
         Score the response for presence of citations and associated excerpts.
         The response is split into claims with associated citations and excerpts by an LLM.
@@ -118,55 +178,107 @@ Return a score on a scale of 0 to 10 indicating how appropriate the response is
         :param response:
         :return: dict of scores for citations per claim and excerpts per citation
         """
-        resp = run_chatopenai(
+        resp = await run_chatopenai_async(
             self.config.model_name,
             system_prompt="You are a helpful assistant.",
-            user_prompt=f"""Here is a response to a question that includes several claims and citations:
-Response: {response}
-
-Split the response into individual claims, citations, and excerpts from the citations, in JSON format: """
-                        '{"claims": [{"claim_text": "...", "citations": [{"citation_text": "...", "excerpts": ["...", ...]}, ...]}, ...]}'
-                        "\n\nIf a claim is missing citations or a citation is not accompanied by excerpts, some lists may be empty in your output.",
+            user_prompt=CLAIMS_USER_PROMPT_HEAD + response + CLAIMS_USER_PROMPT_TAIL,
             json_mode=True,
         )
 
         extracted_json = extract_json_from_response(resp)
         if not extracted_json:
             return {"citations": 0.0, "excerpts": 0.0}
-        citation_score = sum(
-            1 for claim in extracted_json["claims"] if claim["citations"]
-        ) / max(len(extracted_json["claims"]), 1)
+        n_claims, claims_with_citations, n_citations, citations_with_excerpts = 0, 0, 0, 0
+        for claim in extracted_json["claims"]:
+            n_claims += 1
+            if claim["citations"]:
+                claims_with_citations += 1
+                for citation in claim["citations"]:
+                    n_citations += 1
+                    if citation["excerpts"]:
+                        citations_with_excerpts += 1
+        citation_score = claims_with_citations / max(n_claims, 1)
+        excerpt_score = citations_with_excerpts / max(n_citations, 1)
 
-        all_citations = list(
-            itertools.chain.from_iterable(
-                claim["citations"] for claim in extracted_json["claims"]
-            )
+        return {"citations": citation_score, "excerpts": excerpt_score}
+
+    async def _score_properties_batch(
+        self, response: str, question: str, props: List[Tuple[str, str]]
+    ) -> Dict[str, float]:
+        """
+        Score the response as per several annotation rubrics/criteria with a single LLM call.
+        The LLM judges the satisfaction of every rubric/criterion on a scale of 0-10, same as ``_score_property``.
+        :param response: the response to be scored
+        :param question: the question for which the response is being scored
+        :param props: list of (name, rubric/criterion) pairs to be satisfied
+        :return: dict of name to score between 0 and 1; criteria missing from the LLM output are left out
+        """
+        criteria = "\n".join(f'<criterion i="{i + 1}">{prop}</criterion>' for i, (_, prop) in enumerate(props))
+        resp = await run_chatopenai_async(
+            self.config.model_name,
+            system_prompt=PROPERTY_BATCH_SYSTEM_PROMPT.format(n_criteria=len(props)),
+            user_prompt=f"""<question>{question}</question>\n<response>{response}</response>\n<criteria>{criteria}</criteria>""",
+            json_mode=True,
+            max_tokens=50 + 20 * len(props),
         )
-        excerpt_score = sum(
-            1 for citation in all_citations if citation["excerpts"]
-        ) / max(len(all_citations), 1)
 
-        return {"citations": citation_score, "excerpts": excerpt_score}
+        obj = extract_json_from_response(resp)
+        if not obj:
+            return dict()
 
-    def score_output(self, response: str) -> Dict[str, Any]:
+        scores = dict()
+        for item in obj.get("scores", []):
+            try:
+                idx = int(item["i"]) - 1
+                score = float(item["score"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if 0 <= idx < len(props):
+                scores[props[idx][0]] = score / 10.0
+        return scores
+
+    async def _score_other_properties(self, response: str) -> Dict[str, float]:
+        """
+        Score the response for all the annotation rubric properties, i.e. their criteria and supporting evidence.
+        The criteria are judged independently, or together in a single LLM call if ``batch_criteria`` is set.
+        The evidence of a property is only scored once its criterion score is above ``evidence_gate``.
+        :param response: the response to be scored
+        :return: dict of scores for the criteria and evidence of the properties
+        """
+        props = self.config.other_properties
+        criteria = [(x.name, x.criterion) for x in props if x.criterion]
+        score_components = await self._score_properties_batch(
+            response, self.config.question, criteria
+        ) if criteria and self.config.batch_criteria else dict()
+
+        missing = [(name, criterion) for name, criterion in criteria if name not in score_components]
+        if missing and self.config.batch_criteria:
+            LOGGER.warning(f"Batched scoring missed {len(missing)} criteria, scoring them individually")
+        if missing:
+            missing_scores = await asyncio.gather(
+                *(self._score_property(response, self.config.question, criterion) for _, criterion in missing)
+            )
+            score_components.update(zip((name for name, _ in missing), missing_scores))
+
+        evidence_props = [
+            x for x in props
+            if x.evidence and (not x.criterion or score_components.get(x.name, 0.0) > self.config.evidence_gate)
+        ]
+        evidence_scores = await asyncio.gather(
+            *(self._score_evidence(response, x.evidence) for x in evidence_props)
+        )
+        score_components.update({f"{x.name}_evidence": 0.0 for x in props if x.evidence})
+        score_components.update({f"{x.name}_evidence": score for x, score in zip(evidence_props, evidence_scores)})
+        return score_components
+
+    async def ascore_output(self, response: str) -> Dict[str, Any]:
         """
         Compute the cumulative weighted score for a system response such that the final score is between 0 and 1.
+        All the LLM judgements are issued concurrently.
         :param response:
         :return: final weighted score with and without the static components
         """
-        score_weights = {
-            "length": self.config.length_weight,
-            "expertise": self.config.expertise_weight,
-            "citations": self.config.citations_weight,
-            "excerpts": self.config.excerpts_weight,
-        }
-        score_weights.update(
-            {x.name: x.weight / (2.0 if x.evidence else 1.0) for x in self.config.other_properties if x.criterion})
-        score_weights.update(
-            {f"{x.name}_evidence": x.weight / (2.0 if x.criterion else 1.0) for x in self.config.other_properties if
-             x.evidence})
-        assert abs(sum(score_weights.values()) - 1.0) < 1e-6
-
+        score_weights = self._score_weights
         score_components = dict()
 
         score_components["length"] = self._score_length(
@@ -174,26 +286,30 @@ Split the response into individual claims, citations, and excerpts from the cita
             low_length=self.config.low_length,
             high_length=self.config.high_length,
         )
-        score_components["expertise"] = self._score_property(
-            response,
-            self.config.question,
-            "The level of expertise required to understand the answer should be roughly aligned with the estimated expertise of a typical person who would ask the question.",
+        expertise_score, citations_excerpts, other_components = await asyncio.gather(
+            self._score_property(
+                response,
+                self.config.question,
+                EXPERTISE_CRITERION,
+            ),
+            self._score_citations_excerpts(response),
+            self._score_other_properties(response),
         )
-        score_components.update(self._score_citations_excerpts(response))
-
-        for x in self.config.other_properties:
-            if x.criterion:
-                score_components[x.name] = self._score_property(
-                    response, self.config.question, x.criterion
-                )
-            if x.evidence:
-                score_components[f"{x.name}_evidence"] = self._score_evidence(
-                    response, x.evidence) if not x.criterion or score_components.get(x.name) else 0.0
+        score_components["expertise"] = expertise_score
+        score_components.update(citations_excerpts)
+        score_components.update(other_components)
 
         assert set(score_components.keys()) == set(score_weights.keys())
-        score = sum(score_weights[key] * score_components[key] for key in score_weights)
-        static_score_keys = {"length", "expertise", "citations", "excerpts"}
-        # Annotation rubrics are 60% of the total score, so divide by 0.6 to get score out of 1 without the static components
-        ann_score = sum(
-            score_weights[key] * score_components[key] for key in score_weights if key not in static_score_keys) / 0.6
+        score = self._aggregate(score_components)
+        # Divide by the share of the annotation rubrics to get their score out of 1 without the static components
+        ann_score = self._aggregate_ann(score_components) / self._ann_denominator if self._ann_denominator else 0.0
         return {"score": score, "ann_score": ann_score, **score_components}
+
+    def score_output(self, response: str) -> Dict[str, Any]:
+        """
+        Synchronous wrapper around ``ascore_output`` for callers without a running event loop,
+        all calls run on the shared event loop of ``run_utils.run_sync``.
+        :param response:
+        :return: final weighted score with and without the static components
+        """
+        return run_sync(self.ascore_output(response))
@@ -1,25 +1,29 @@
 import hashlib
-import json
-from typing import Any, Dict, List
-from run_utils import extract_json_from_response, run_chatopenai
-from litellm.caching import Cache
-import litellm
+from typing import Any, Dict, List, Tuple
 
-from tqdm import tqdm
+import orjson
+from run_utils import (
+    configure_cache,
+    configure_http_clients,
+    extract_json_from_response,
+    run_chatopenai_many_async,
+    run_sync,
+)
+
+from tqdm.asyncio import tqdm
 
 annotations = []
-with open("data/output_snippets.jsonl", "r") as f:
+with open("data/output_snippets.jsonl", "rb") as f:
     for line in f:
-        annotations.append(json.loads(line))
+        annotations.append(orjson.loads(line))
 
 test_cases = []
 
-litellm.cache = Cache(type="disk", disk_cache_dir="./data/litellm_cache/")
+configure_cache()
+configure_http_clients()
 
 
-def gpt_filter(query: str, ingredients: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    if not ingredients:
-        return ingredients
+def gpt_filter_prompts(query: str, ingredients: List[Dict[str, Any]]) -> Tuple[str, str]:
     context = "\n\n".join([f"{i + 1}. Criterion: {x['text']}\nSupporting quotes: {x['snippets']}" for i, x in enumerate(ingredients)])
     system_prompt = f"""You will be given a question someone asked to a scientific assistant (in <question></question> tags).
     You will then be provided with a list of criterion numbered from 1 to {len(ingredients)} alon with supporting quotes from publications, 
@@ -27,7 +31,10 @@ def gpt_filter(query: str, ingredients: List[Dict[str, Any]]) -> List[Dict[str,
     Your job is to filter out the criterion that are not directly relevant to answering the question.
     Output the required criterion index/ordinal as a JSON: {{"criterion": [1, 2, 4,...]}}."""
     user_prompt = f"""<question>{query}</question>\n<criterion>{context}</criterion>"""
-    resp = run_chatopenai("gpt-4-turbo", system_prompt, user_prompt, json_mode=True)
+    return system_prompt, user_prompt
+
+
+def gpt_filter_apply(resp: str, ingredients: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     obj = extract_json_from_response(resp)
     if not obj:
         return ingredients
@@ -35,6 +42,28 @@ def gpt_filter(query: str, ingredients: List[Dict[str, Any]]) -> List[Dict[str,
     return [ingredients[i - 1] for i in obj["criterion"] if 0 <= (i - 1) < len(ingredients)]
 
 
+async def filter_ingredients(concurrency: int = 20):
+    """Filter the most important and nice to have ingredients of all the annotations concurrently."""
+    # Empty ingredient lists have nothing to filter
+    to_filter = [
+        (d["question"], d["ingredients"], key)
+        for d in annotations
+        for key in ("most_important", "nice_to_have")
+        if d["ingredients"][key]
+    ]
+    responses = await run_chatopenai_many_async(
+        "gpt-4-turbo",
+        [gpt_filter_prompts(question, ingredients[key]) for question, ingredients, key in to_filter],
+        json_mode=True,
+        concurrency=concurrency,
+        show_progress=True,
+    )
+    for (_, ingredients, key), resp in zip(to_filter, responses):
+        ingredients[key] = gpt_filter_apply(resp, ingredients[key])
+
+
+run_sync(filter_ingredients())
+
 for d in tqdm(annotations):
     qn = {
         "initial_prompt": d["question"],
@@ -51,6 +80,7 @@ for d in tqdm(annotations):
                 "other_properties": [],
             },
         },
+        # case_id must stay the md5 of str((question, spreadsheet id)), the system response files are keyed by it
         "case_id": hashlib.md5(
             str((d["question"], d["spreadsheet"]["id"])).encode("utf-8")
         )
@@ -58,9 +88,6 @@ for d in tqdm(annotations):
         .hex(),
     }
 
-    d["ingredients"]["most_important"] = gpt_filter(d["question"], d["ingredients"]["most_important"])
-    d["ingredients"]["nice_to_have"] = gpt_filter(d["question"], d["ingredients"]["nice_to_have"])
-
     if (
             len(d["ingredients"]["nice_to_have"]) != 0
             and len(d["ingredients"]["most_important"]) != 0
@@ -102,5 +129,5 @@ for d in tqdm(annotations):
     qn["agreement"] = d["agreement"]
     test_cases.append(qn)
 
-with open("data/test_configs_snippets_gpt.json", "w") as f:
-    json.dump(test_cases, f, indent=2)
+with open("data/test_configs_snippets_gpt.json", "wb") as f:
+    f.write(orjson.dumps(test_cases, option=orjson.OPT_INDENT_2))
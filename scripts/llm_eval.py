@@ -1,43 +1,71 @@
 import argparse
-import json
+import asyncio
+import functools
+import hashlib
 import logging
+import os
+import sqlite3
 import statistics
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Any, Dict, List
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Mapping, Optional
 
-import litellm
+import msgspec
 import numpy as np
+import orjson
 import scipy.stats
-from corpusqa_rubric import RubricCorpusQaGenericMetric
-from litellm.caching import Cache
-from pydantic.v1 import BaseModel, Field
-from tqdm import tqdm
-import glob
+from corpusqa_rubric import RubricCorpusQaGenericMetric, struct_kwargs
+from run_utils import CACHE_MODES, configure_cache, configure_http_clients, configure_rate_limit, run_sync
+from tqdm.asyncio import tqdm
 
 LOGGER = logging.getLogger(__name__)
 
+# qa files larger than this are kept in an on-disk sqlite table instead of a dict to bound the memory usage
+LARGE_QA_FILE_BYTES = 100 * 1024 * 1024
+READ_BUFFER_BYTES = 8 * 1024 * 1024
+READ_CHUNK_BYTES = 1024 * 1024
+OUTPUT_FORMATS = ("json", "jsonl")
 
-class TestCase(BaseModel):
-    case_id: str = Field(description="The ID of the case.")
-    annotator: str = Field(description="Annotator id for the question.")
-    agreement: bool = Field(
-        description="Indicator whether the question is annotated by multiple annotators."
-    )
 
-    initial_prompt: str = Field(
-        description="The initial query from the user to the system."
-    )
-    metric_config: Dict[str, Any] = Field(
-        description="The metric to use to score the response."
-    )
-    response: str = Field(description="The response from the system.")
+@functools.lru_cache(maxsize=None)
+def get_metric(config_json: bytes, validate: bool = False) -> RubricCorpusQaGenericMetric:
+    """Metric for the serialized rubric config, shared by all the test cases with the same config.
+    :param config_json: rubric config serialized with sorted keys
+    :param validate: whether to validate the config schema
+    """
+    return RubricCorpusQaGenericMetric(orjson.loads(config_json), validate=validate)
+
+
+class TestCase(msgspec.Struct, gc=False):
+    """A system response to be scored against the rubric config of a test query.
+
+    - case_id: The ID of the case.
+    - annotator: Annotator id for the question.
+    - agreement: Indicator whether the question is annotated by multiple annotators.
+    - initial_prompt: The initial query from the user to the system.
+    - metric_config: The metric to use to score the response.
+    - response: The response from the system.
+    - validate_config: Whether to validate the metric config before scoring.
+    """
+
+    case_id: str
+    annotator: str
+    agreement: bool
+    initial_prompt: str
+    metric_config: Dict[str, Any]
+    response: str
+    validate_config: bool = False
 
     def run(self) -> Dict[str, Any]:
-        """Run the test case and return the results."""
-        metric = RubricCorpusQaGenericMetric(self.metric_config["config"])
+        """Run the test case and return the results, on the shared event loop of ``run_utils.run_sync``."""
+        return run_sync(self.run_async())
+
+    async def run_async(self) -> Dict[str, Any]:
+        """Run the test case without blocking the event loop and return the results."""
+        config_json = orjson.dumps(self.metric_config["config"], option=orjson.OPT_SORT_KEYS)
+        metric = get_metric(config_json, self.validate_config)
         resp = dict()
-        resp["scores"] = metric.score_output(self.response)
+        resp["scores"] = await metric.ascore_output(self.response)
         resp["case_id"] = self.case_id
         resp["annotator"] = self.annotator
         resp["agreement"] = self.agreement
@@ -45,74 +73,266 @@ class TestCase(BaseModel):
         return resp
 
 
+class SqliteResponses(Mapping[str, str]):
+    """Read-only mapping of test case_id to system response, stored in a temporary on-disk sqlite table."""
+
+    def __init__(self, responses: Iterable[Dict[str, Any]]):
+        # An empty database name makes sqlite use a private temporary file, deleted when the connection is closed
+        self.conn = sqlite3.connect("", check_same_thread=False)
+        self.conn.execute("CREATE TABLE responses (case_id TEXT PRIMARY KEY, response TEXT)")
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?)",
+            ((qa["case_id"], qa["answer_text"]) for qa in responses),
+        )
+        self.conn.commit()
+
+    def __getitem__(self, case_id: str) -> str:
+        row = self.conn.execute("SELECT response FROM responses WHERE case_id = ?", (case_id,)).fetchone()
+        if row is None:
+            raise KeyError(case_id)
+        return row[0]
+
+    def __contains__(self, case_id: object) -> bool:
+        return self.conn.execute("SELECT 1 FROM responses WHERE case_id = ?", (case_id,)).fetchone() is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return (row[0] for row in self.conn.execute("SELECT case_id FROM responses"))
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+class JsonlWriter:
+    """Appends records to a jsonl file as they come, writing them out in batches of ``flush_every`` lines."""
+
+    def __init__(self, path: str, flush_every: int = 64):
+        self.f = open(path, "wb")
+        self.flush_every = flush_every
+        self.buffer = bytearray()
+        self.pending = 0
+
+    def write(self, record: Dict[str, Any]):
+        self.buffer += orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.f.write(self.buffer)
+        self.buffer.clear()
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self) -> "JsonlWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 class LlmEval:
-    def __init__(self, test_config: List[Dict[str, Any]], responses: Dict[str, str], use_rubrics: bool,
-                 use_snippets: bool):
+    def __init__(self, test_config: List[Dict[str, Any]], responses: Mapping[str, str], use_rubrics: bool,
+                 use_snippets: bool, strict_validate: bool = False, batch_criteria: bool = False,
+                 evidence_gate: float = 0.0):
         self.test_configs = test_config
         self.responses = responses
         self.use_snippets = use_snippets
         self.use_rubrics = use_rubrics
+        self.strict_validate = strict_validate
+        self.batch_criteria = batch_criteria
+        self.evidence_gate = evidence_gate
+
+    def prepare_metric_config(self, metric_config: Dict[str, Any]) -> Dict[str, Any]:
+        """Copy of the ``metric_config`` of a test query with the evaluation settings applied,
+        the test configs themselves are left untouched so that they can be shared across sources.
+        """
+        config = dict(metric_config["config"])
+        if not (self.use_rubrics and self.use_snippets):
+            other_properties = []
+            for prop in config["other_properties"]:
+                prop = dict(prop)
+                if not self.use_rubrics:
+                    prop["criterion"] = ""
+                if not self.use_snippets:
+                    prop["evidence"] = []
+                other_properties.append(prop)
+            config["other_properties"] = other_properties
+        if self.batch_criteria:
+            config["batch_criteria"] = True
+        if self.evidence_gate:
+            config["evidence_gate"] = self.evidence_gate
+        return {**metric_config, "config": config}
 
     def make_test_cases(
             self, skip_duplicate_annotations: bool = True
-    ) -> List[TestCase]:
-        """Create a list of ``TestCase`` objects by mapping each system response to each test query.
+    ) -> Iterator[TestCase]:
+        """Lazily create ``TestCase`` objects by mapping each system response to each test query.
         param: skip_duplicate_annotations: Skip duplicate annotations for the same query.
-        return: list of test cases
+        return: generator of test cases
         """
-        test_cases = []
         seen_agreements = set()
         for conf in self.test_configs:
             if conf["case_id"] not in self.responses:
                 continue
-            if not self.use_rubrics:
-                for prop in conf["metric_config"]["config"]["other_properties"]:
-                    prop["criterion"] = ""
-            if not self.use_snippets:
-                for prop in conf["metric_config"]["config"]["other_properties"]:
-                    prop["evidence"] = []
-            conf["response"] = self.responses[conf["case_id"]]
             if (
                     conf["initial_prompt"] in seen_agreements
                     and skip_duplicate_annotations
             ):
                 continue
             seen_agreements.add(conf["initial_prompt"])
-            test_cases.append(TestCase(**conf))
-        return test_cases
+            conf = {
+                **conf,
+                "metric_config": self.prepare_metric_config(conf["metric_config"]),
+                "response": self.responses[conf["case_id"]],
+            }
+            if self.strict_validate:
+                yield msgspec.convert({**conf, "validate_config": True}, type=TestCase)
+            else:
+                yield TestCase(**struct_kwargs(TestCase, conf))
+
+
+def scoring_key(test_case: TestCase) -> bytes:
+    """Key of the scoring work of a test case, the scores only depend on the metric config and the response."""
+    payload = orjson.dumps([test_case.metric_config, test_case.response], option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+
+async def run_test_cases(
+        test_cases: Iterable[TestCase], concurrency: int, scorings: Optional[Dict[bytes, asyncio.Task]] = None,
+        on_result: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> List[Dict[str, Any]]:
+    """Run the ``test_cases`` concurrently, with at most ``concurrency`` of them in flight at any time.
+    The next test case is only taken from ``test_cases`` once one of the running ones is done, so that no more
+    than ``concurrency`` test cases (and their responses) are held in memory at once.
+    :param test_cases: test cases to be evaluated
+    :param concurrency: maximum number of test cases evaluated in parallel
+    :param scorings: scoring tasks by ``scoring_key``, test cases with the same key reuse the scores of the first one
+    :param on_result: called with each result as soon as it is available
+    :returns results of the test cases in the order of completion
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    if scorings is None:
+        scorings = dict()
+    results = []
+    progress = tqdm(unit="case")
+
+    async def run_shared(test_case: TestCase, scoring: asyncio.Task) -> Dict[str, Any]:
+        resp = dict(await scoring)
+        resp["case_id"] = test_case.case_id
+        resp["annotator"] = test_case.annotator
+        resp["agreement"] = test_case.agreement
+        resp["question"] = test_case.initial_prompt
+        return resp
+
+    async def run_one(test_case: TestCase):
+        try:
+            key = scoring_key(test_case)
+            if key in scorings:
+                result = await run_shared(test_case, scorings[key])
+            else:
+                scorings[key] = asyncio.create_task(test_case.run_async())
+                result = await scorings[key]
+            results.append(result)
+            progress.update()
+            if on_result is not None:
+                on_result(result)
+        finally:
+            semaphore.release()
+
+    tasks = []
+    test_cases = iter(test_cases)
+    while True:
+        # Wait for a free slot before taking the next test case out of the (lazy) iterable
+        await semaphore.acquire()
+        test_case = next(test_cases, None)
+        if test_case is None:
+            semaphore.release()
+            break
+        tasks.append(asyncio.create_task(run_one(test_case)))
+    await asyncio.gather(*tasks)
+    progress.close()
+    return results
+
+
+async def run_all_sources(
+        test_cases_by_src: Dict[str, Iterable[TestCase]], concurrency: int, sink: Optional[JsonlWriter] = None
+) -> Dict[str, List[Dict[str, Any]]]:
+    """Run the test cases of every source on a single event loop, so that the async LLM clients are shared.
+    :param test_cases_by_src: test cases to be evaluated for each source
+    :param concurrency: maximum number of test cases evaluated in parallel
+    :param sink: if given, each result is written to it with its source as soon as it is available
+    :returns results of the test cases for each source, sorted by annotator and case_id
+    """
+    results_by_src = dict()
+    # Identical responses of different sources (common across ablations) are only scored once
+    scorings = dict()
+    for src, test_cases in test_cases_by_src.items():
+        print(f"Running test cases for src: {src}...")
+        on_result = None if sink is None else lambda res, src=src: sink.write({"src": src, **res})
+        results_by_src[src] = await run_test_cases(test_cases, concurrency, scorings, on_result)
+        print(f"Ran {len(results_by_src[src])} tests for src: {src}...")
+        results_by_src[src].sort(key=lambda x: (x["annotator"], x["case_id"]))
+    return results_by_src
 
 
 def calculate_icc(scores1, scores2):
     """Calculate the intraclass correlation"""
-    score_pairs = list(zip(scores1, scores2))
-    n = len(score_pairs)
-    grand_mean = np.mean(scores1 + scores2)
+    a = np.asarray(scores1, dtype=np.float64)
+    b = np.asarray(scores2, dtype=np.float64)
+    n = len(a)
+    # Sums of the scores, their squares and products give all the centered sums without centering the arrays
+    sum_a, sum_b = a.sum(), b.sum()
+    grand_mean = (sum_a + sum_b) / (2 * n)
 
-    sum1 = sum((x - grand_mean) ** 2 for x in scores1)
-    sum2 = sum((x - grand_mean) ** 2 for x in scores2)
-    s2 = (sum1 + sum2) / (2 * n - 1)
+    sum_sq = a @ a + b @ b - 2 * grand_mean * (sum_a + sum_b) + 2 * n * grand_mean ** 2
+    s2 = sum_sq / (2 * n - 1)
 
-    icc = sum((x - grand_mean) * (y - grand_mean) for x, y in score_pairs) / (
-            (n - 1) * s2
-    )
+    sum_prod = a @ b - grand_mean * (sum_a + sum_b) + n * grand_mean ** 2
+    icc = sum_prod / ((n - 1) * s2)
     return icc
 
 
-def load_sys_responses(qa_files: List[str]) -> Dict[str, Dict[str, str]]:
-    """Load system answers for each test query by iterating over the ``qa_files`` jsonl files.
+def iter_jsonl(f: BinaryIO) -> Iterator[Dict[str, Any]]:
+    """Decode the records of a jsonl file read in chunks of ``READ_CHUNK_BYTES``, skipping empty lines.
+    :param f: jsonl file opened in binary mode
+    """
+    partial = b""
+    while chunk := f.read1(READ_CHUNK_BYTES):
+        lines = (partial + chunk).split(b"\n")
+        # The last line is incomplete unless the chunk ended on a newline, carry it over to the next chunk
+        partial = lines.pop()
+        for line in lines:
+            if line:
+                yield orjson.loads(line)
+    if partial.strip():
+        yield orjson.loads(partial)
+
+
+def read_sys_responses(qa_file: str) -> Mapping[str, str]:
+    """Read the system answers from a single jsonl ``qa_file``.
+    Files larger than ``LARGE_QA_FILE_BYTES`` are loaded into an on-disk sqlite table instead of memory.
+        :param qa_file: path to the jsonl file containing system responses
+        :returns mapping of test case_id to response
+    """
+    with open(qa_file, "rb", buffering=READ_BUFFER_BYTES) as f:
+        if os.path.getsize(qa_file) > LARGE_QA_FILE_BYTES:
+            return SqliteResponses(iter_jsonl(f))
+        return {qa["case_id"]: qa["answer_text"] for qa in iter_jsonl(f)}
+
+
+def load_sys_responses(qa_files: List[str]) -> Dict[str, Mapping[str, str]]:
+    """Load system answers for each test query by reading the ``qa_files`` jsonl files in parallel.
         :param qa_files: list of paths to the jsonl files containing system responses
-        :returns sys_response dict with keys as the qa_files names and values as the dict of test case_id to response
+        :returns sys_response dict with keys as the qa_files names and values as the mapping of test case_id to response
     """
-    sys_responses = dict()
-    for qa_file in qa_files:
-        curr_responses = dict()
-        print(f"Reading responses for source {qa_file}...")
-        with open(qa_file) as f:
-            for line in f:
-                qa = json.loads(line)
-                curr_responses[qa["case_id"]] = qa["answer_text"]
-        print(f"{len(curr_responses)} responses obtained for eval...")
-        sys_responses[qa_file] = curr_responses
+    print(f"Reading responses for sources {qa_files}...")
+    with ThreadPoolExecutor(max_workers=max(1, min(32, len(qa_files)))) as executor:
+        sys_responses = dict(zip(qa_files, executor.map(read_sys_responses, qa_files)))
+    for qa_file, curr_responses in sys_responses.items():
+        print(f"{len(curr_responses)} responses obtained for eval from {qa_file}...")
     return sys_responses
 
 
@@ -134,8 +354,16 @@ def main():
     parser.add_argument(
         "--output",
         type=str,
-        default=f"./data/results_{datetime.now().strftime('%Y%m%d%H%M%S%f')}.json",
-        help="output file to store the results of the evaluation",
+        default=None,
+        help="output file to store the results of the evaluation "
+             "(default: ./data/results_<timestamp>.json or .jsonl, as per --output-format)",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        help="json: a single object with the sorted results of each source, written at the end of the run, "
+             "jsonl: one line per result with its src, written as the results come in",
+        default="json",
     )
     parser.add_argument(
         "--agreement",
@@ -161,56 +389,101 @@ def main():
         help="names of the source files to evaluate (comma separated with .jsonl extension)",
         default=None,
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="Maximum number of test cases evaluated in parallel (match it to the rate limits of the LLM provider)",
+        default=32,
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        help="Maximum number of LLM requests per minute, no limit by default",
+        default=None,
+    )
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        help="Maximum number of (estimated) LLM tokens per minute, no limit by default",
+        default=None,
+    )
+    parser.add_argument(
+        "--batch-criteria",
+        action="store_true",
+        help="Judge all the rubric criteria of a question in a single LLM call instead of one call per criterion "
+             "(faster and cheaper, but scores are not comparable with the per-criterion default)",
+        default=False,
+    )
+    parser.add_argument(
+        "--evidence-gate",
+        type=float,
+        help="Only score the snippets of a rubric item if its criterion score (between 0 and 1) is above this value",
+        default=0.0,
+    )
+    parser.add_argument(
+        "--cache-mode",
+        choices=CACHE_MODES,
+        help="enabled: cache LLM responses on disk and reuse them, replay: only reuse cached responses and fail on a "
+             "missing one, disabled: always query the LLM",
+        default="enabled",
+    )
+    parser.add_argument(
+        "--strict-validate",
+        action="store_true",
+        help="Validate the test config schema, use when the test config is not generated by create_test_cases.py",
+        default=False,
+    )
 
     args = parser.parse_args()
+    if args.output is None:
+        args.output = f"./data/results_{datetime.now().strftime('%Y%m%d%H%M%S%f')}.{args.output_format}"
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if (args.rpm is not None and args.rpm < 1) or (args.tpm is not None and args.tpm < 1):
+        parser.error("--rpm and --tpm must be at least 1")
 
-    litellm.cache = Cache(type="disk", disk_cache_dir="./data/litellm_cache/")
+    configure_cache(args.cache_mode)
+    configure_http_clients()
+    configure_rate_limit(args.rpm, args.tpm)
 
     # If src_names is provided, only evaluate those files, else all the jsonl files under args.qa_dir directory
     if args.src_names:
         srcs = [s.strip() for s in args.src_names.split(",")]
         qa_files = [f"{args.qa_dir}/{src}.jsonl" for src in srcs]
     else:
-        qa_files = glob.glob(f"{args.qa_dir}/*.jsonl")
+        with os.scandir(args.qa_dir) as entries:
+            qa_files = [
+                entry.path for entry in entries
+                if entry.name.endswith(".jsonl") and not entry.name.startswith(".") and entry.is_file()
+            ]
     qa_files.sort()
     print(f"{len(qa_files)} src files found: {qa_files}")
 
     sys_responses = load_sys_responses(qa_files)
 
     # Load the scoring rubrics and weights for each test case
-    test_config = json.load(open(args.test_config, "r"))
+    with open(args.test_config, "rb") as f:
+        test_config = orjson.loads(f.read())
 
-    results_by_src = dict()
-    qn_by_case = dict()
+    test_cases_by_src = dict()
 
     # Evaluate each system under consideration for its responses to each test case
     for src, responses in sys_responses.items():
-        llm_eval = LlmEval(test_config, responses, args.rubrics, args.snippets)
-        print(f"Creating test cases for src: {src}...")
-        test_cases = llm_eval.make_test_cases(
+        llm_eval = LlmEval(test_config, responses, args.rubrics, args.snippets, args.strict_validate,
+                           args.batch_criteria, args.evidence_gate)
+        test_cases_by_src[src] = llm_eval.make_test_cases(
             skip_duplicate_annotations=(not args.agreement)
         )
-        print(f"Created {len(test_cases)} tests for src: {src}...")
-
-        for test_case in test_cases:
-            qn_by_case[test_case.case_id] = test_case.initial_prompt
-        results_by_src[src] = []
 
-        # Evaluate all the test cases in parallel
-        print(f"Running test cases for src: {src}...")
-        with ThreadPoolExecutor(max_workers=32) as executor:
-            future_to_test_case = {
-                executor.submit(test_case.run): test_case for test_case in test_cases
-            }
-            for future in tqdm(
-                    as_completed(future_to_test_case), total=len(test_cases)
-            ):
-                results_by_src[src].append(future.result())
-        results_by_src[src].sort(key=lambda x: (x["annotator"], x["case_id"]))
-
-    with open(args.output, "w") as f:
-        json.dump(results_by_src, f)
-        print(f"Results written to {args.output}\n")
+    # Evaluate all the test cases in parallel
+    if args.output_format == "jsonl":
+        with JsonlWriter(args.output) as sink:
+            results_by_src = run_sync(run_all_sources(test_cases_by_src, args.concurrency, sink))
+    else:
+        results_by_src = run_sync(run_all_sources(test_cases_by_src, args.concurrency))
+        with open(args.output, "wb") as f:
+            f.write(orjson.dumps(results_by_src))
+    print(f"Results written to {args.output}\n")
 
     for src, results in results_by_src.items():
         print(
@@ -226,16 +499,12 @@ def main():
         for src, results in results_by_src.items():
             for res in results:
                 if res["agreement"]:
-                    if res["question"] not in qn_results:
-                        qn_results[res["question"]] = [[], []]
-                    if res["annotator"] == "Annotator 1 Assignments":
-                        qn_results[res["question"]][0].append(res["scores"]["ann_score"])
-                    else:
-                        qn_results[res["question"]][1].append(res["scores"]["ann_score"])
+                    ann_idx = 0 if res["annotator"] == "Annotator 1 Assignments" else 1
+                    qn_results.setdefault(res["question"], ([], []))[ann_idx].append(res["scores"]["ann_score"])
         ktaus, pcorr = [], []
         for qn, scores in qn_results.items():
-            ann1, ann2 = [x for x in scores[0]], [x for x in scores[1]]
-            if len(set(ann1)) ==1 or len(set(ann2)) == 1:
+            ann1, ann2 = np.asarray(scores[0], dtype=np.float64), np.asarray(scores[1], dtype=np.float64)
+            if ann1.min() == ann1.max() or ann2.min() == ann2.max():
                 ktaus.append(0.0)
                 pcorr.append(0.0)
             else:
@@ -1,17 +1,22 @@
 import argparse
-import json
+import logging
 import os
-import re
-from typing import Callable
+from typing import Callable, Dict, Iterable, Optional, Set
 
+import diskcache
+import orjson
 import requests
 from google.auth.transport.requests import Request
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from tqdm import tqdm
 from isounidecode import unidecode
 
+LOGGER = logging.getLogger(__name__)
+
 S2_API_KEY = os.environ.get("S2_API_KEY")
 # If modifying these scopes, delete the file token.json.
 SCOPES = [
@@ -24,6 +29,49 @@ SCOPES = [
 
 CLIENT_SECRET_FILE = "cred.json"
 TOKEN_FILE = "token.json"
+# Maximum number of calls in a single Google API batch request
+DOCS_BATCH_SIZE = 100
+OUTPUT_BUFFER_BYTES = 1024 * 1024
+# Number of output entries written between flushes to disk
+OUTPUT_FLUSH_EVERY = 64
+# Downloaded docs are kept here across runs, annotation docs rarely change during a labeling session
+DOC_CACHE_DIR = "data/.doc_cache"
+# Docs that could not be parsed, skipped on later runs without downloading them again
+FAILED_DOCS_FILE = "data/failed_doc_ids.jsonl"
+# Only the parts of a doc used by the parse functions are downloaded. The element indices are kept so that
+# non-text elements stay in the elements lists as empty entries
+_DOC_FIELDS = (
+    "body(content(paragraph("
+    "elements(startIndex,endIndex,textRun(content,textStyle(bold,fontSize,link))),"
+    "paragraphStyle(headingId),bullet)))"
+)
+# Maximum number of paper ids in a single S2 paper/batch request
+S2_BATCH_SIZE = 500
+
+# Indices of the questions in the qa metadata that are annotated by multiple annotators
+_AGREEMENT_QIDX = frozenset(range(5)) | frozenset(range(25, 30))
+
+# Titles of the S2 papers looked up so far, by corpus id
+_S2_TITLE_CACHE: Dict[int, str] = dict()
+
+# Keep-alive session for the S2 calls, retrying rate limited and failed requests with backoff
+# (paper/batch is a read-only lookup, so the POST is safe to retry)
+_S2_SESSION = requests.Session()
+_S2_SESSION.headers.update({"x-api-key": S2_API_KEY} if S2_API_KEY else {})
+_S2_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=None,
+            raise_on_status=False,
+        ),
+    ),
+)
 
 
 def get_credentials():
@@ -46,7 +94,30 @@ def get_credentials():
     return creds
 
 
+def fetch_s2_titles(corpus_ids: Iterable[int]):
+    """Look up the titles of the papers not in _S2_TITLE_CACHE yet, with S2 batch requests of up to S2_BATCH_SIZE ids."""
+    missing_ids = [corpus_id for corpus_id in dict.fromkeys(corpus_ids) if corpus_id not in _S2_TITLE_CACHE]
+    for i in range(0, len(missing_ids), S2_BATCH_SIZE):
+        r = _S2_SESSION.post(
+            "https://api.semanticscholar.org/graph/v1/paper/batch",
+            params={"fields": "externalIds,title"},
+            json={
+                "ids": [
+                    f"CorpusID:{corpus_id}" for corpus_id in missing_ids[i:i + S2_BATCH_SIZE]
+                ]
+            },
+        )
+        if r.status_code == 200:
+            rjson = r.json()
+            for paper in rjson:
+                # Unknown ids come back as null
+                if paper:
+                    _S2_TITLE_CACHE[int(paper["externalIds"]["CorpusId"])] = paper["title"]
+
+
 def format_nora_ans(nora_ans, question):
+    # Look up the titles of the citations of all the sections at once
+    fetch_s2_titles(citation["corpus_id"] for section in nora_ans for citation in section["citations"])
     nora_text = ""
     for section in nora_ans:
         header = f"{section['title']}\nTLDR: {section['tldr']}"
@@ -54,25 +125,9 @@ def format_nora_ans(nora_ans, question):
         citations = section["citations"]
         cite_text = ""
         if citations:
-            r = requests.post(
-                "https://api.semanticscholar.org/graph/v1/paper/batch",
-                params={"fields": "externalIds,title"},
-                json={
-                    "ids": [
-                        f"CorpusID:{citation['corpus_id']}" for citation in citations
-                    ]
-                },
-                headers={"x-api-key": S2_API_KEY},
-            )
-            title_dict = {}
-            if r.status_code == 200:
-                rjson = r.json()
-                for paper in rjson:
-                    title_dict[int(paper["externalIds"]["CorpusId"])] = paper["title"]
-
             for j, citation in enumerate(citations):
-                if citation["corpus_id"] in title_dict:
-                    cite_text += f"{j + 1}. [{citation['id']} | n_citations: {citation['n_citations']} | {title_dict[citation['corpus_id']]} ]: \n{'... '.join(citation['snippets'])}\n\n"
+                if citation["corpus_id"] in _S2_TITLE_CACHE:
+                    cite_text += f"{j + 1}. [{citation['id']} | n_citations: {citation['n_citations']} | {_S2_TITLE_CACHE[citation['corpus_id']]} ]: \n{'... '.join(citation['snippets'])}\n\n"
             if not cite_text:
                 print(question)
             text += "\n\nReferences:\n" + cite_text
@@ -81,48 +136,94 @@ def format_nora_ans(nora_ans, question):
 
 
 def list_spreadsheets(service, folder_id):
-    results = (
-        service.files()
-        .list(
-            q=f"'{folder_id}' in parents and mimeType='application/vnd.google-apps.spreadsheet' and name contains 'Annotator'",
-            spaces="drive",
-            fields="nextPageToken, files(id, name)",
+    files = []
+    page_token = None
+    while True:
+        results = (
+            service.files()
+            .list(
+                q=f"'{folder_id}' in parents and mimeType='application/vnd.google-apps.spreadsheet' and name contains 'Annotator'",
+                spaces="drive",
+                pageSize=1000,
+                fields="nextPageToken, files(id, name)",
+                pageToken=page_token,
+            )
+            .execute()
         )
-        .execute()
-    )
-    return results.get("files", [])
+        files += results.get("files", [])
+        page_token = results.get("nextPageToken")
+        if page_token is None:
+            return files
 
 
 def read_spreadsheet(service, spreadsheet_id):
     # Assuming data starts after two header rows and you need columns A, B, and C
     ranges = ["A4:C28", "A31:C55", "A58:C62"]
+    result = (
+        service.spreadsheets()
+        .values()
+        .batchGet(spreadsheetId=spreadsheet_id, ranges=ranges)
+        .execute()
+    )
     cumul_result = []
-    for range_name in ranges:
-        result = (
-            service.spreadsheets()
-            .values()
-            .get(spreadsheetId=spreadsheet_id, range=range_name)
-            .execute()
-        )
-        cumul_result += result.get("values", [])
+    for value_range in result.get("valueRanges", []):
+        cumul_result += value_range.get("values", [])
     return cumul_result
 
 
-def download_doc_content(docs_service, doc_id):
-    doc = docs_service.documents().get(documentId=doc_id).execute()
+def download_doc_content(docs_service, doc_id, doc_cache: Optional[diskcache.Cache] = None):
+    if doc_cache is not None and doc_id in doc_cache:
+        return doc_cache[doc_id]
+    doc = docs_service.documents().get(documentId=doc_id, fields=_DOC_FIELDS).execute()
+    if doc_cache is not None:
+        doc_cache[doc_id] = doc
     return doc
 
 
-def para2txt(para: dict, map_fn: Callable[[str], str] = lambda x: x):
+def download_docs_content(
+        docs_service, doc_ids: Iterable[str], doc_cache: Optional[diskcache.Cache] = None
+) -> Dict[str, dict]:
+    """Download the given docs with batch requests of up to DOCS_BATCH_SIZE docs each.
+    Docs found in ``doc_cache`` are not downloaded again, and the downloaded ones are added to it.
+    """
+    docs = dict()
+
+    def store_doc(request_id, response, exception):
+        if exception is not None:
+            raise exception
+        docs[request_id] = response
+        if doc_cache is not None:
+            doc_cache[request_id] = response
+
+    doc_ids = list(dict.fromkeys(doc_ids))
+    if doc_cache is not None:
+        for doc_id in doc_ids:
+            doc = doc_cache.get(doc_id)
+            if doc is not None:
+                docs[doc_id] = doc
+        doc_ids = [doc_id for doc_id in doc_ids if doc_id not in docs]
+    for i in range(0, len(doc_ids), DOCS_BATCH_SIZE):
+        batch = docs_service.new_batch_http_request(callback=store_doc)
+        for doc_id in doc_ids[i:i + DOCS_BATCH_SIZE]:
+            batch.add(docs_service.documents().get(documentId=doc_id, fields=_DOC_FIELDS), request_id=doc_id)
+        batch.execute()
+    return docs
+
+
+def para2txt(para: dict, map_fn: Optional[Callable[[str], str]] = None):
+    # str.join builds its result faster from a list than from a generator
+    if map_fn is None:
+        return "".join([x["textRun"]["content"] for x in para["elements"]])
     return "".join([map_fn(x["textRun"]["content"]) for x in para["elements"]])
 
 
 def element_to_markdown(elem: dict):
-    elem_txt = elem["textRun"]["content"]
+    text_run = elem["textRun"]
+    elem_txt = text_run["content"]
     if elem_txt.strip() == "":
         return elem_txt
 
-    elem_style = elem["textRun"].get("textStyle", dict())
+    elem_style = text_run.get("textStyle", dict())
 
     if elem_style.get("fontSize", dict()).get("magnitude", 12) >= 15:
         if not elem_txt.strip().startswith("#"):
@@ -131,17 +232,10 @@ def element_to_markdown(elem: dict):
 
     if elem_style.get("bold", False):
         if not elem_txt.strip().startswith("*"):
-            pieces = ["", elem_txt, ""]
-            m1 = re.search(r"^\s+", pieces[1])
-            if m1:
-                pieces[0] = m1.string[: m1.start()]
-                pieces[1] = m1.string[m1.start():]
-            m2 = re.search(r"\s+$", pieces[1])
-            if m2:
-                pieces[1] = m2.string[: m2.start()]
-                pieces[2] = m2.string[m2.start():]
-            pieces[1] = f"**{pieces[1]}**"
-            elem_txt = "".join(pieces)
+            # Keep the surrounding whitespace outside of the markers, "** x**" is not rendered as bold
+            body = elem_txt.strip()
+            lead_len = len(elem_txt) - len(elem_txt.lstrip())
+            elem_txt = f"{elem_txt[:lead_len]}**{body}**{elem_txt[lead_len + len(body):]}"
 
     if "url" in elem_style.get("link", dict()):
         url = elem_style["link"]["url"]
@@ -151,15 +245,18 @@ def element_to_markdown(elem: dict):
     return elem_txt
 
 
-def paragraph_to_markdown(para: dict, map_fn: Callable[[str], str] = lambda x: x):
-    markdown = "".join([map_fn(element_to_markdown(x)) for x in para["elements"]])
+def paragraph_to_markdown(para: dict, map_fn: Optional[Callable[[str], str]] = None):
+    if map_fn is None:
+        markdown = "".join([element_to_markdown(x) for x in para["elements"]])
+    else:
+        markdown = "".join([map_fn(element_to_markdown(x)) for x in para["elements"]])
     if "bullet" in para:
         markdown = f"- {markdown}"
     return markdown
 
 
 def parse_ingredients_from_doc(doc):
-    paragraphs = [x["paragraph"] for x in doc["body"]["content"] if "paragraph" in x]
+    paragraphs = (x["paragraph"] for x in doc["body"]["content"] if "paragraph" in x)
     most_important_paras = []
     nice_to_have_paras = []
     other_paras = []
@@ -167,30 +264,22 @@ def parse_ingredients_from_doc(doc):
     parse_snippets = False
     pre_quotes, post_quotes = False, False
     snippet_para = {"elements": []}
+    section_paras = {"most important": most_important_paras, "nice to have": nice_to_have_paras}
     for para in paragraphs:
-        if len(para.get("elements", [])) >= 1:
-            if "textRun" not in para["elements"][0]:
+        elements = para.get("elements", [])
+        if len(elements) >= 1:
+            if "textRun" not in elements[0]:
                 continue
-            if (
-                    para["elements"][0]["textRun"]["content"].lower().strip()
-                    == "most important"
-            ):
-                cur_lst = most_important_paras
-                parse_snippets = False
-            elif (
-                    para["elements"][0]["textRun"]["content"].lower().strip()
-                    == "nice to have"
-            ):
-                cur_lst = nice_to_have_paras
+            first_txt = elements[0]["textRun"]["content"].lower().strip()
+            if first_txt in section_paras:
+                cur_lst = section_paras[first_txt]
                 parse_snippets = False
             elif "bullet" in para and not pre_quotes:
                 cur_lst.append({"text": para, "snippets": []})
                 parse_snippets = True
-            elif (
-                    para["elements"][0]["textRun"]["content"].lower().strip()
-                    == "supporting quotes"
-            ) or (para["elements"][-1]["textRun"]["content"].lower().strip()
-                  == "supporting quotes"):
+            elif first_txt == "supporting quotes" or (
+                    elements[-1]["textRun"]["content"].lower().strip() == "supporting quotes"
+            ):
                 parse_snippets = True
             elif parse_snippets:
                 for element in para["elements"]:
@@ -221,7 +310,7 @@ def parse_ingredients_from_doc(doc):
 
 
 def parse_sources_from_doc(doc):
-    paragraphs = [x["paragraph"] for x in doc["body"]["content"] if "paragraph" in x]
+    paragraphs = (x["paragraph"] for x in doc["body"]["content"] if "paragraph" in x)
     sources = []
 
     for para in paragraphs:
@@ -254,6 +343,18 @@ def parse_sources_from_doc(doc):
     return sources
 
 
+def load_failed_doc_ids(path: str = FAILED_DOCS_FILE) -> Set[str]:
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb") as f:
+        return {orjson.loads(line)["id"] for line in f if line.strip()}
+
+
+def record_failed_doc(doc_id: str, error: Exception, path: str = FAILED_DOCS_FILE):
+    with open(path, "ab") as f:
+        f.write(orjson.dumps({"id": doc_id, "err": repr(error)}, option=orjson.OPT_APPEND_NEWLINE))
+
+
 def extract_doc_id_from_url(url):
     # Extract the document ID from the URL
     return url.split("/d/")[1].split("/")[0]
@@ -290,76 +391,94 @@ def main():
         help="Metadata JSON file containing the questions, links and source answers",
         default="data/qa_metadata_all.jsonl",
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"Download and parse all the docs again, instead of reusing the ones cached under {DOC_CACHE_DIR} "
+             f"and skipping the ones that failed to parse in earlier runs (listed in {FAILED_DOCS_FILE})",
+        default=False,
+    )
     args = parser.parse_args()
 
     qa_metadata = []
-    with open(args.json_meta, "r") as f:
+    with open(args.json_meta, "rb") as f:
         for line in f:
-            qa_metadata.append(json.loads(line))
+            qa_metadata.append(orjson.loads(line))
 
     qa_rev_idx = {
         qa_meta["question"].strip(): i for i, qa_meta in enumerate(qa_metadata)
     }
-    agreement_qidx = [i for i in range(5)] + [i for i in range(25, 30, 1)]
     creds = get_credentials()
     drive_service = build("drive", "v3", credentials=creds)
     sheets_service = build("sheets", "v4", credentials=creds)
     docs_service = build("docs", "v1", credentials=creds)
 
+    doc_cache = None if args.no_cache else diskcache.Cache(DOC_CACHE_DIR)
+    failed_doc_ids = set() if args.no_cache else load_failed_doc_ids()
+
     spreadsheets = list_spreadsheets(drive_service, args.folder_id)
-    data = []
 
     print(f"Found {len(spreadsheets)} spreadsheets")
 
-    for spreadsheet in spreadsheets:
-        print(f"Processing spreadsheet: {spreadsheet['id']}")
-        rows = read_spreadsheet(sheets_service, spreadsheet["id"])
-        for row in tqdm(rows):
-            if len(row) >= 3:
-                question, doc_link, sources_link = row
-                qidx = qa_rev_idx[question.strip()]
-                print(f"Processing ingredients doc: {doc_link} for question: {question}")
-                qmeta = qa_metadata[qidx]
-                if qidx not in agreement_qidx:
-                    qmeta["key_ingredients"] = [doc_link]
-                ingredients_doc = download_doc_content(
-                    docs_service,
-                    extract_doc_id_from_url(doc_link),
-                )
-                try:
-                    ingredients = parse_ingredients_from_doc(ingredients_doc)
-                    ingredients = {k: [ing for ing in v if ing["text"] != "__"] for k, v in ingredients.items()}
-
-                except:
-                    print(f"Error parsing ingredients doc: {doc_link}")
+    n_entries = 0
+    with open("data/output_snippets.jsonl", "wb", buffering=OUTPUT_BUFFER_BYTES) as f:
+        for spreadsheet in spreadsheets:
+            print(f"Processing spreadsheet: {spreadsheet['id']}")
+            rows = read_spreadsheet(sheets_service, spreadsheet["id"])
+            ingredients_docs = download_docs_content(
+                docs_service,
+                (
+                    doc_id for doc_id in (extract_doc_id_from_url(row[1]) for row in rows if len(row) >= 3)
+                    if doc_id not in failed_doc_ids
+                ),
+                doc_cache,
+            )
+            for row in tqdm(rows):
+                if len(row) >= 3:
+                    question, doc_link, sources_link = row
+                    qidx = qa_rev_idx[question.strip()]
+                    print(f"Processing ingredients doc: {doc_link} for question: {question}")
+                    qmeta = qa_metadata[qidx]
+                    if qidx not in _AGREEMENT_QIDX:
+                        qmeta["key_ingredients"] = [doc_link]
+                    doc_id = extract_doc_id_from_url(doc_link)
                     ingredients = {"most_important": [], "nice_to_have": []}
-
-                # print(f"Processing sources doc: {sources_link}")
-                # sources_doc = download_doc_content(
-                #     docs_service,
-                #     extract_doc_id_from_url(sources_link),
-                # )
-                # sources_answers = parse_sources_from_doc(sources_doc)
-                sources_answers = [
-                    {"name": qsrc, "answer_txt": qans}
-                    for qsrc, qans in qmeta["src_answers"].items()
-                ]
-                # get_nora_answer(sources_answers, question)
-                data.append(
-                    {
+                    if doc_id in failed_doc_ids:
+                        print(f"Skipping ingredients doc that failed to parse before: {doc_link}")
+                    else:
+                        try:
+                            ingredients = parse_ingredients_from_doc(ingredients_docs[doc_id])
+                            ingredients = {k: [ing for ing in v if ing["text"] != "__"] for k, v in ingredients.items()}
+                        except (KeyError, TypeError, IndexError) as e:
+                            LOGGER.exception(f"Error parsing ingredients doc: {doc_link}")
+                            failed_doc_ids.add(doc_id)
+                            record_failed_doc(doc_id, e)
+
+                    # print(f"Processing sources doc: {sources_link}")
+                    # sources_doc = download_doc_content(
+                    #     docs_service,
+                    #     extract_doc_id_from_url(sources_link),
+                    # )
+                    # sources_answers = parse_sources_from_doc(sources_doc)
+                    sources_answers = [
+                        {"name": qsrc, "answer_txt": qans}
+                        for qsrc, qans in qmeta["src_answers"].items()
+                    ]
+                    # get_nora_answer(sources_answers, question)
+                    entry = {
                         "spreadsheet": spreadsheet,
                         "question": question,
                         "ingredients": ingredients,
                         "ingredients_doc_link": doc_link,
                         "sources": sources_answers,
                         "sources_doc_link": sources_link,
-                        "agreement": False if qidx not in agreement_qidx else True,
+                        "agreement": qidx in _AGREEMENT_QIDX,
                     }
-                )
-
-    with open("data/output_snippets.jsonl", "w") as f:
-        for entry in data:
-            f.write(json.dumps(entry) + "\n")
+                    # Flush the entries regularly, so that most of the rows done so far survive a failure
+                    f.write(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE))
+                    n_entries += 1
+                    if n_entries % OUTPUT_FLUSH_EVERY == 0:
+                        f.flush()
 
 
 if __name__ == "__main__":
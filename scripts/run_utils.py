@@ -1,30 +1,188 @@
-import json
+import asyncio
+import hashlib
 import logging
-from typing import Any, Dict, Optional
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Dict, List, Optional, Tuple, TypeVar
 
+import diskcache
+import httpx
 import litellm
+import orjson
+from tqdm.asyncio import tqdm
 
 LOGGER = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+LLM_CACHE_DIR = "./data/llm_cache/"
+# enabled: read and write the disk cache, replay: only read it and fail on a miss, disabled: do not use it
+CACHE_MODES = ("enabled", "replay", "disabled")
+
+# Identical requests within a process (e.g. the same response scored against rubrics of multiple annotators)
+# are answered from memory, and concurrent duplicates share a single in-flight call
+_MEMO_MAXSIZE = 4096
+_memo: "OrderedDict[str, str]" = OrderedDict()
+_in_flight: Dict[str, "asyncio.Task[str]"] = dict()
+
+_disk_cache: Optional[diskcache.Cache] = None
+_cache_mode = "disabled"
+_rate_limit: Optional["TokenBucket"] = None
+_sync_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+class CacheMissError(LookupError):
+    """Raised in replay mode for an LLM request that has no cached response."""
+
+
+def configure_cache(mode: str = "enabled", cache_dir: str = LLM_CACHE_DIR):
+    """Persist LLM responses on disk so that re-runs over the same prompts do not hit the provider again.
+    :param mode: one of ``CACHE_MODES``
+    :param cache_dir: directory of the disk cache
+    """
+    global _disk_cache, _cache_mode
+    if mode not in CACHE_MODES:
+        raise ValueError(f"Unknown cache mode {mode}, expected one of {CACHE_MODES}")
+    _cache_mode = mode
+    _disk_cache = diskcache.Cache(cache_dir) if mode != "disabled" else None
+
+
+class TokenBucket:
+    """Limits the requests and tokens per minute sent to the LLM provider, so that calls wait for capacity
+    instead of being rejected with rate limit errors and retried with backoff.
+    Each limit is a bucket refilled continuously at its per minute rate, up to one minute worth of capacity.
+    """
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm or 0)
+        self.tokens = float(tpm or 0)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self.updated = now - self.updated, now
+        if self.rpm:
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens: int):
+        """Wait until a request with an estimated ``tokens`` fits in both limits and take its capacity."""
+        # A request larger than the token limit waits for a full bucket, instead of forever
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+        # Waiters are served one at a time, in order of arrival
+        async with self.lock:
+            while True:
+                self._refill()
+                wait = 0.0
+                if self.rpm and self.requests < 1:
+                    wait = (1 - self.requests) * 60 / self.rpm
+                if self.tpm and self.tokens < tokens:
+                    wait = max(wait, (tokens - self.tokens) * 60 / self.tpm)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            if self.rpm:
+                self.requests -= 1
+            self.tokens -= tokens
+
+
+def configure_rate_limit(rpm: Optional[int] = None, tpm: Optional[int] = None):
+    """Limit the async LLM calls to ``rpm`` requests and ``tpm`` tokens per minute, no limit if both are None."""
+    global _rate_limit
+    _rate_limit = TokenBucket(rpm, tpm) if rpm or tpm else None
+
+
+def _estimate_tokens(msgs: List[Dict[str, str]], chat_kwargs: Dict[str, Any]) -> int:
+    # Roughly 4 characters per token for the prompt, plus the completion budget if one is set
+    return sum(len(msg["content"]) for msg in msgs) // 4 + chat_kwargs.get("max_tokens", 0)
+
+
+def run_sync(coro: Awaitable[T]) -> T:
+    """Run ``coro`` to completion from synchronous code, on one event loop kept for the whole process.
+    Unlike ``asyncio.run``, repeated calls share the loop, which the shared async HTTP clients of litellm, the
+    in-flight calls and the rate limiter are bound to once used. Cannot be called from a running event loop.
+    """
+    global _sync_loop
+    if _sync_loop is None or _sync_loop.is_closed():
+        _sync_loop = asyncio.new_event_loop()
+    return _sync_loop.run_until_complete(coro)
+
+
+def configure_http_clients(max_connections: int = 100, max_keepalive_connections: int = 50):
+    """Share pooled HTTP/2 clients across all the LLM calls so that connections are reused instead of re-established."""
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+    litellm.client_session = httpx.Client(http2=True, limits=limits)
+    litellm.aclient_session = httpx.AsyncClient(http2=True, limits=limits)
+
+
+def _request_key(model_name: str, msgs: List[Dict[str, str]], chat_kwargs: Dict[str, Any]) -> str:
+    request = {"model": model_name, "messages": msgs, **chat_kwargs}
+    return hashlib.sha256(orjson.dumps(request, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+def _cache_get(key: str) -> Optional[str]:
+    content = _memo.get(key)
+    if content is not None:
+        _memo.move_to_end(key)
+        return content
+    if _disk_cache is not None:
+        content = _disk_cache.get(key)
+        if content is not None:
+            _memo_put(key, content)
+            return content
+    if _cache_mode == "replay":
+        raise CacheMissError(f"No cached response for LLM request {key}")
+    return None
+
+
+def _memo_put(key: str, content: str):
+    _memo[key] = content
+    if len(_memo) > _MEMO_MAXSIZE:
+        _memo.popitem(last=False)
+
+
+def _cache_put(key: str, content: str):
+    _memo_put(key, content)
+    if _disk_cache is not None and _cache_mode == "enabled":
+        _disk_cache.set(key, content)
+
 
 def extract_json_from_response(response: str) -> Optional[Dict[str, Any]]:
+    # find/rfind are single C-level scans from either end, only the outermost braces are needed
     json_start = response.find("{")
     json_end = response.rfind("}") + 1
-    if json_start == -1 or json_end == -1:
+    if json_start == -1 or json_end <= json_start:
         return None
 
     try:
-        return json.loads(response[json_start:json_end])
-    except json.JSONDecodeError:
+        return orjson.loads(response[json_start:json_end])
+    except orjson.JSONDecodeError:
         try:
-            return json.loads(response[json_start:json_end]+"]}")
-        except json.JSONDecodeError:
+            return orjson.loads(response[json_start:json_end]+"]}")
+        except orjson.JSONDecodeError:
             LOGGER.warning(
                 f"Could not decode JSON from response: {response[json_start:json_end]}"
             )
         return None
 
 
+def _build_messages(
+    system_prompt: Optional[str], user_prompt: str
+) -> List[Dict[str, str]]:
+    return (
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ]
+        if system_prompt is not None
+        else [{"role": "user", "content": user_prompt}]
+    )
+
+
 def run_chatopenai(
     model_name: str,
     system_prompt: Optional[str],
@@ -35,18 +193,109 @@ def run_chatopenai(
     chat_kwargs["temperature"] = chat_kwargs.get("temperature", 0)
     if json_mode:
         chat_kwargs["response_format"] = {"type": "json_object"}
-    msgs = (
-        [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ]
-        if system_prompt is not None
-        else [{"role": "user", "content": user_prompt}]
-    )
+    msgs = _build_messages(system_prompt, user_prompt)
+    key = _request_key(model_name, msgs, chat_kwargs)
+    content = _cache_get(key)
+    if content is not None:
+        return content
+
     resp = litellm.completion(
         model=model_name,
         messages=msgs,
         **chat_kwargs,
     )
 
+    content = resp.choices[0].message.content
+    _cache_put(key, content)
+    return content
+
+
+async def _acompletion(model_name: str, msgs: List[Dict[str, str]], chat_kwargs: Dict[str, Any]) -> str:
+    if _rate_limit is not None:
+        await _rate_limit.acquire(_estimate_tokens(msgs, chat_kwargs))
+    resp = await litellm.acompletion(
+        model=model_name,
+        messages=msgs,
+        **chat_kwargs,
+    )
     return resp.choices[0].message.content
+
+
+async def run_chatopenai_async(
+    model_name: str,
+    system_prompt: Optional[str],
+    user_prompt: str,
+    json_mode: bool = False,
+    **chat_kwargs,
+) -> str:
+    """Async counterpart of ``run_chatopenai`` backed by ``litellm.acompletion``."""
+    chat_kwargs["temperature"] = chat_kwargs.get("temperature", 0)
+    if json_mode:
+        chat_kwargs["response_format"] = {"type": "json_object"}
+    msgs = _build_messages(system_prompt, user_prompt)
+    key = _request_key(model_name, msgs, chat_kwargs)
+    content = _cache_get(key)
+    if content is not None:
+        return content
+
+    loop = asyncio.get_running_loop()
+    task = _in_flight.get(key)
+    if task is None or task.get_loop() is not loop:
+        task = loop.create_task(_acompletion(model_name, msgs, chat_kwargs))
+        _in_flight[key] = task
+        task.add_done_callback(lambda t: _in_flight.pop(key, None) if _in_flight.get(key) is t else None)
+
+    # Shield the shared call so that a cancelled caller does not cancel it for the other callers
+    content = await asyncio.shield(task)
+    _cache_put(key, content)
+    return content
+
+
+async def run_chatopenai_many_async(
+    model_name: str,
+    prompts: List[Tuple[Optional[str], str]],
+    json_mode: bool = False,
+    concurrency: int = 16,
+    max_retries: int = 3,
+    show_progress: bool = False,
+    **chat_kwargs,
+) -> List[str]:
+    """Run ``run_chatopenai_async`` for each (system prompt, user prompt) pair in ``prompts`` concurrently,
+    with at most ``concurrency`` calls in flight. Rate limited calls are retried up to ``max_retries`` times
+    with exponential backoff.
+    :param show_progress: show a progress bar of the completed calls
+    :returns responses in the order of ``prompts``
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_bounded(system_prompt: Optional[str], user_prompt: str) -> str:
+        async with semaphore:
+            for attempt in range(max_retries + 1):
+                try:
+                    return await run_chatopenai_async(
+                        model_name, system_prompt, user_prompt, json_mode=json_mode, **chat_kwargs
+                    )
+                except litellm.RateLimitError:
+                    if attempt == max_retries:
+                        raise
+                    LOGGER.warning(f"Rate limited by {model_name}, retrying in {2 ** attempt}s")
+                    await asyncio.sleep(2 ** attempt)
+
+    gather = tqdm.gather if show_progress else asyncio.gather
+    return await gather(*(run_bounded(system_prompt, user_prompt) for system_prompt, user_prompt in prompts))
+
+
+def run_chatopenai_many(
+    model_name: str,
+    prompts: List[Tuple[Optional[str], str]],
+    json_mode: bool = False,
+    concurrency: int = 16,
+    max_retries: int = 3,
+    **chat_kwargs,
+) -> List[str]:
+    """Blocking wrapper of ``run_chatopenai_many_async``, for callers outside of an event loop.
+    Runs on the shared event loop of ``run_sync``, so it can be called repeatedly.
+    """
+    return run_sync(
+        run_chatopenai_many_async(model_name, prompts, json_mode, concurrency, max_retries, **chat_kwargs)
+    )